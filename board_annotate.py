@@ -21,16 +21,24 @@
 import os
 import io
 import sys
-import copy
 import base64
+import concurrent.futures
+import functools
+import hashlib
+import itertools
+import json
 import math
+import operator
 import random
+import struct
+from collections import OrderedDict
 from enum import Enum, IntEnum
-from typing import (Generator, Self, List, Tuple, Optional, Dict, Any)
+from typing import (Self, List, Tuple, Optional, Dict, Any, Iterator)
 from contextlib import redirect_stderr
 import argparse
 import yaml
 import gi
+import cairo
 import inkex
 
 # https://gitlab.com/inkscape/extras/extension-manager/-/issues/24#note_1080113589
@@ -47,10 +55,47 @@ for msg in (val for val in h.getvalue().splitlines(keepends=True)
     sys.stderr.write(msg)
 
 
+# libyaml based loader when PyYAML was built with it
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Parsed YAML configs by path: (mtime, size, config)
+YAML_CACHE: OrderedDict[str, Tuple[float, int, Any]] = OrderedDict()
+YAML_CACHE_SIZE = 16
+# stored in the on-disk YAML caches, bump it if the cached layout changes
+YAML_CACHE_FORMAT = 1
+
+# svg renders without selections, by sha256 of the serialized svg
+RENDER_CACHE: OrderedDict[bytes, GdkPixbuf.Pixbuf] = OrderedDict()
+RENDER_CACHE_SIZE = 4
+# svg render size in pixels, the short side covers context images
+# (0.4 of the short side drawn at 360px) without upscaling,
+# the long side is capped for very wide or tall documents
+RENDER_SHORT_SIDE = 900
+RENDER_MAX_SIDE = 2048
+# selection icon size in pixels, icons are cut from the svg render
+SELECTION_ICON_SIZE = 64
+
+# embedded image data URIs by (path, mtime, size)
+EMBED_CACHE: OrderedDict[Tuple[str, float, int], str] = OrderedDict()
+EMBED_CACHE_SIZE = 32
+
+# _debug_print only prints with BOARD_ANNOTATE_DEBUG set in the environment
+DEBUG = bool(os.environ.get('BOARD_ANNOTATE_DEBUG'))
+
+# rows added to the chip and selection lists per idle callback
+IDLE_FILL_BATCH = 10
+
 # Globals
 INKSCAPE_SVG: inkex.SvgDocumentElement = None
 YAML_FILE: str = ''
-YAML_CONFIG = yaml.load("", Loader=yaml.SafeLoader)
+# read-only once loaded (it is shared with YAML_CACHE)
+YAML_CONFIG: Any = None
+# annotation stroke width (1mm in user units), set in annotate_board
+STROKE_WIDTH: float = 0.0
+# title and description font sizes (10pt and 8pt in user units),
+# set in annotate_board
+TITLE_FONT_SIZE: float = 0.0
+DESC_FONT_SIZE: float = 0.0
 
 
 class BoardAnnotateExtension(inkex.EffectExtension):
@@ -60,6 +105,8 @@ class BoardAnnotateExtension(inkex.EffectExtension):
         """Handle arguments from board_annotate.inx dialog"""
         pars.add_argument('--yaml-file', type=str,
                           help='Board YAML configuration')
+        pars.add_argument('--yaml-cache', type=inkex.Boolean, default=False,
+                          help='Cache the parsed YAML next to the file')
         pars.add_argument('--tab', dest='tab',
                           help='The selected UI tab when Apply was pressed')
 
@@ -76,9 +123,15 @@ class BoardAnnotateExtension(inkex.EffectExtension):
         if (YAML_FILE is not None and not os.path.isdir(YAML_FILE)):
             # see https://gitlab.com/inkscape/inkscape/-/issues/2822
             # for why isdir check is used
-            with open(YAML_FILE, 'r', encoding='utf-8') as file:
-                YAML_CONFIG = yaml.safe_load(file)
+            YAML_CONFIG = load_yaml_config(YAML_FILE,
+                                           self.options.yaml_cache)
 
+        # check the config before anything expensive (rendering) happens
+        try:
+            self.check_config()
+        except ValueError as error:
+            inkex.utils.errormsg(error)
+            raise inkex.utils.AbortExtension
         # validate color settings in the yaml config
         # (so user gets warned before trying to match chips)
         AnnotateColors.validate_colors(YAML_CONFIG)
@@ -87,75 +140,173 @@ class BoardAnnotateExtension(inkex.EffectExtension):
         except ValueError as error:
             inkex.utils.errormsg(error)
             raise inkex.utils.AbortExtension
-        # TODO probably could do some more early checks
 
-        SelectionApp(start_loop=True,
-                     selection=sorted_selection)
+        app = SelectionApp(start_loop=True,
+                           selection=sorted_selection,
+                           svg=self.svg)
+        if app.fill_failed:
+            raise inkex.utils.AbortExtension
+
+    def check_config(self) -> None:
+        """Check the YAML config and the document have what the GUI needs
+        raises ValueError describing the first problem found"""
+        if not isinstance(YAML_CONFIG, dict):
+            raise ValueError("No YAML config loaded. Select the YAML file "
+                             "describing the board")
+        if not YAML_CONFIG.get('chips'):
+            raise ValueError("YAML config has no chips")
+        for chip in YAML_CONFIG['chips']:
+            if not isinstance(chip, dict):
+                raise ValueError(f"YAML config chip is not a mapping: {chip}")
+            missing = [key for key in ('name', 'description', 'chip_photo')
+                       if key not in chip]
+            if missing:
+                raise ValueError(
+                    f"YAML config chip '{chip.get('name', '')}' is missing "
+                    f"{', '.join(missing)} (use \"\" for empty fields)")
+        if YAML_CONFIG.get('gutter') not in ("horizontal", "vertical"):
+            raise ValueError("YAML config gutter is not "
+                             "'horizontal' or 'vertical' ")
+        if INKSCAPE_SVG.viewbox_width <= 0 or INKSCAPE_SVG.viewbox_height <= 0:
+            raise ValueError("The document has no width or height to render")
 
     def sort_check_selection(self) -> inkex.elements._selected.ElementList:
         """Sort selection rectangles left to right or top to bottom
-        also checks for invalid selections, and a valid gutter setting"""
+        also checks for invalid selections
+        (the gutter setting is checked by check_config)"""
         if len(INKSCAPE_SVG.selection) == 0:
             inkex.utils.errormsg(
                 "No items selected. Board annotate needs "
                 "at least one rectangle selected to annotate")
             raise inkex.utils.AbortExtension
 
+        # horizontal sorts left to right, vertical sorts top to bottom
+        horizontal = YAML_CONFIG['gutter'] == "horizontal"
+        # (sort key, item) pairs so each bounding box is only computed once
+        decorated = []
         for item in INKSCAPE_SVG.selection:
-            if str(item) != 'rect':
-                item_id = item.get_id()
+            # compare tags, BoardAnnotateImage makes <image> elements
+            # inkex.Rectangle instances
+            tag = str(item)
+            if tag != 'rect':
                 inkex.utils.errormsg(
                     f"Invalid items selected\n"
-                    f"Found '{str(item)}':'{item_id}' in selection\n"
+                    f"Found '{tag}':'{item.get_id()}' in selection\n"
                     f"Board annotate only works on rectangles")
                 raise inkex.utils.AbortExtension
-        if YAML_CONFIG['gutter'] == "horizontal":  # left to right
-            return sorted(INKSCAPE_SVG.selection,
-                          key=lambda e: float(e.bounding_box().center_x))
-        if YAML_CONFIG['gutter'] == "vertical":  # top to bottom
-            return sorted(INKSCAPE_SVG.selection,
-                          key=lambda e: float(e.bounding_box().center_y))
+            bounding_box = item.bounding_box()
+            decorated.append((float(bounding_box.center_x if horizontal
+                                    else bounding_box.center_y), item))
+
+        decorated.sort(key=operator.itemgetter(0))
+        return [item for _, item in decorated]
+
+
+def load_yaml_config(path: str, json_cache: bool = False) -> Any:
+    """Return the parsed YAML file at path
+    reuses an earlier parse if the file's mtime and size haven't changed,
+    so the returned config is shared and must be treated as read-only
+    json_cache keeps parses in a json file next to the YAML file,
+    per content-version for files with that header"""
+    stat = os.stat(path)
+    cached = YAML_CACHE.get(path)
+    if cached is not None and cached[:2] == (stat.st_mtime, stat.st_size):
+        YAML_CACHE.move_to_end(path)
+        return cached[2]
+
+    # bytes are passed straight to the parser, it handles the decoding
+    with open(path, 'rb') as file:
+        cache_path = None
+        # what the YAML file must still match for its cache to be used
+        source: List[float] = []
+        if json_cache:
+            cache_path = yaml_version_cache_path(path, file.readline())
+            if cache_path is not None:
+                # the version stands in for the mtime, the size catches
+                # edits made without changing the version
+                source = [stat.st_size]
+            else:
+                cache_path = f"{path}.cache.json"
+                source = [stat.st_mtime, stat.st_size]
+        config = None
+        if cache_path is not None:
+            config = load_yaml_json_cache(cache_path, source)
+        if config is None:
+            if YAML_LOADER is yaml.SafeLoader:
+                _debug_print("PyYAML was built without libyaml,",
+                             "using the slower pure Python loader")
+            file.seek(0)
+            config = yaml.load(file, Loader=YAML_LOADER)
+            if cache_path is not None:
+                save_yaml_json_cache(cache_path, source, config)
+
+    YAML_CACHE[path] = (stat.st_mtime, stat.st_size, config)
+    YAML_CACHE.move_to_end(path)
+    if len(YAML_CACHE) > YAML_CACHE_SIZE:
+        YAML_CACHE.popitem(last=False)
+    return config
+
+
+def yaml_version_cache_path(path: str, first_line: bytes) -> Optional[str]:
+    """Return the parse cache path for a YAML file starting with
+    '# content-version: <version>', or None without that header"""
+    prefix = b'# content-version:'
+    if not first_line.startswith(prefix):
+        return None
+    version = first_line[len(prefix):].strip().decode('ascii', 'replace')
+    # the version ends up in a file name
+    if not version.isalnum():
+        return None
+    return f"{path}.{version}.cache"
+
+
+def load_yaml_json_cache(cache_path: str, source: List[float]) -> Any:
+    """Return the config from the YAML json cache at cache_path,
+    or None if there isn't one made from a YAML file matching source"""
+    try:
+        with open(cache_path, 'rb') as cache:
+            cached = json.load(cache)
+        # an exact match, copies can keep an older file's timestamps
+        if (cached.get('format') != YAML_CACHE_FORMAT or
+                cached.get('source') != source):
+            return None
+        return cached['config']
+    except (OSError, ValueError, AttributeError, KeyError):
+        return None
 
-        raise ValueError("YAML config gutter is not "
-                         "'horizontal' or 'vertical' ")
+
+def save_yaml_json_cache(cache_path: str, source: List[float],
+                         config: Any) -> None:
+    """Write config to the YAML json cache at cache_path,
+    source is what the YAML file must match for the cache to be used"""
+    try:
+        # configs with values json can't hold (like dates) aren't cached
+        data = json.dumps({'format': YAML_CACHE_FORMAT,
+                           'source': source,
+                           'config': config})
+        # write and rename so a reader never sees a partial file
+        with open(f"{cache_path}.tmp", 'w', encoding='utf-8') as cache:
+            cache.write(data)
+        os.replace(f"{cache_path}.tmp", cache_path)
+    except (OSError, TypeError, ValueError):
+        # the cache is optional, e.g. read-only directories
+        pass
 
 
 class ChipItem(GObject.Object):
     '''Info and images for a chip'''
-    name = ''
-    description = ''
-    image_path = ''
-    image = None
-    widget = None
-
     def __init__(self, builder: Gtk.Builder, name: str, description: str,
-                 image_path: str) -> None:
+                 image_path: str,
+                 icon_image: Optional[GdkPixbuf.Pixbuf]) -> None:
         super().__init__()
 
         self.name = name
         self.description = description
         self.image_path = image_path
-        if image_path and not os.path.isabs(image_path):
-            self.image_path = os.path.join(
-                os.path.dirname(YAML_FILE), image_path)
-
-        self.tooltip_image = (None if image_path == "" else
-                              GdkPixbuf.Pixbuf.new_from_file_at_size(
-                                  self.image_path, 256, 256))
-
-        self.icon_image = None
-        if self.tooltip_image is not None:
-            icon_width = self.tooltip_image.get_width() / 8
-            icon_height = self.tooltip_image.get_height() / 8
-            self.icon_image = GdkPixbuf.Pixbuf.new(
-                self.tooltip_image.get_colorspace(),
-                self.tooltip_image.get_has_alpha(),
-                self.tooltip_image.get_bits_per_sample(),
-                icon_width, icon_height)
-            self.tooltip_image.scale(self.icon_image,
-                                     0, 0, icon_width, icon_height,
-                                     0, 0, 1/8, 1/8,
-                                     GdkPixbuf.InterpType.BILINEAR)
+        self.icon_image = icon_image
+        # loaded on the first tooltip, most photos are never hovered
+        self.tooltip_image: Optional[GdkPixbuf.Pixbuf] = None
+        self.image_size: Optional[Tuple[int, int]] = None
 
         self.widget = builder.get_object('chip_item')
         chip_name = builder.get_object('chip_name')
@@ -163,17 +314,28 @@ class ChipItem(GObject.Object):
         Gtk.Widget.set_tooltip_text(chip_name, self.description)
 
         if self.icon_image:
-            self.image = GdkPixbuf.Pixbuf.new_from_file(self.image_path)
+            self.image_size = chip_image_size(self.image_path)
             chip_image = builder.get_object('chip_image')
             chip_image.set_from_pixbuf(self.icon_image)
             chip_image.set_has_tooltip(True)
             chip_image.connect('query-tooltip', self.on_query_tooltip)
 
+    @staticmethod
+    def load_icon_image(image_path: str) -> Optional[GdkPixbuf.Pixbuf]:
+        '''Load the chip photo at icon size (None without a photo)'''
+        if not image_path:
+            return None
+        # the loader scales while decoding (jpeg decodes at reduced size)
+        return GdkPixbuf.Pixbuf.new_from_file_at_size(image_path, 32, 32)
+
     def on_query_tooltip(self, widget: Gtk.Widget, tooltip_x: int,
                          tooltip_y: int, keyboard_mode: bool,
                          tooltip: Gtk.Tooltip) -> bool:
         '''Set image tooltip to larger image'''
         # pylint: disable=unused-argument,too-many-arguments
+        if self.tooltip_image is None:
+            self.tooltip_image = GdkPixbuf.Pixbuf.new_from_file_at_size(
+                self.image_path, 256, 256)
         tooltip.set_icon(self.tooltip_image)
         return True
 
@@ -207,7 +369,7 @@ class SelectionWindow(inkex.gui.Window):
         self.setup_chip_items()
         self.setup_selections_and_icon_view()
         self.setup_accelerators()
-        self.populate_status_bar(selection_items)
+        self.populate_status_bar()
 
         # misc signal connections
         self.widget('chip_reverse').connect('toggled', self.update_reverse)
@@ -223,13 +385,17 @@ class SelectionWindow(inkex.gui.Window):
     def setup_chip_items(self) -> None:
         '''a Gio.ListStore backing the chip selection ListBox'''
         self.chip_items = Gio.ListStore.new(ChipItem)
+        # chip_items positions by chip name (the first, for duplicate names)
+        self.chip_index_by_name: Dict[str, int] = {}
         # Chips defined in user provided yaml
+        # relative chip photo paths are relative to the yaml file
+        yaml_dir = os.path.dirname(YAML_FILE)
+        image_paths = []
         for chip in YAML_CONFIG['chips']:
-            builder = Gtk.Builder()
-            builder.add_from_file(self.gapp.get_ui_file(self.name))
-            self.chip_items.append(
-                ChipItem(builder, chip['name'], chip['description'],
-                         chip['chip_photo']))
+            image_path = chip['chip_photo']
+            if image_path and not os.path.isabs(image_path):
+                image_path = os.path.join(yaml_dir, image_path)
+            image_paths.append(image_path)
 
         chip_list_box = self.widget('chip_list_box')
         chip_list_box.bind_model(self.chip_items, ChipItem.as_widget)
@@ -237,39 +403,130 @@ class SelectionWindow(inkex.gui.Window):
         chip_list_box.connect('selected-rows-changed',
                               self.check_unselect_match)
 
+        # chips are added once the window is showing
+        GLib.idle_add(
+            self.close_on_fill_error(self.fill_chip_items(image_paths))
+            .__next__)
+
+    def close_on_fill_error(self, fill: Iterator[bool]) -> Iterator[bool]:
+        '''Run an idle fill generator, reporting any error and closing
+        the window, rather than leaving a partly filled list'''
+        try:
+            yield from fill
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            # e.g. a missing or unreadable chip photo
+            inkex.utils.errormsg(f"Board annotate could not fill the "
+                                 f"chip and selection lists:\n{error}")
+            self.gapp.fill_failed = True
+            Gtk.main_quit()
+            yield False
+
+    def fill_chip_items(self, image_paths: List[str]) -> Iterator[bool]:
+        '''Add chips to chip_items a batch at a time
+        (an idle callback, yields False when done)'''
+        # every chip row comes from the same ui definition, read it once
+        with open(self.gapp.get_ui_file(self.name),
+                  encoding='utf-8') as ui_file:
+            chip_ui = ui_file.read()
+
+        # decoding the photos is the slow part, and doesn't touch any
+        # widgets, so do it on a thread pool
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            chips = zip(YAML_CONFIG['chips'], image_paths,
+                        executor.map(ChipItem.load_icon_image,
+                                     image_paths))
+            while batch := list(itertools.islice(chips, IDLE_FILL_BATCH)):
+                items = []
+                for chip, image_path, icon_image in batch:
+                    # only build the chip row, not the whole window
+                    builder = Gtk.Builder()
+                    builder.add_objects_from_string(chip_ui, ['chip_item'])
+                    items.append(ChipItem(builder, chip['name'],
+                                          chip['description'],
+                                          image_path, icon_image))
+                # one items-changed signal per batch
+                start = self.chip_items.get_n_items()
+                self.chip_items.splice(start, 0, items)
+                for index, item in enumerate(items, start):
+                    self.chip_index_by_name.setdefault(item.name, index)
+                yield True
+        yield False
+
     def setup_selections_and_icon_view(self) -> None:
         '''Gtk.ListStore backing a the Selections IconView'''
         # User selected rectangles to be matched with a chip
         selection_items = self.widget('selection_items')
 
-        # render the svg for creating icon subpixbufs
-        svg_render = svg_without_selections_as_pixbuf(
-            INKSCAPE_SVG, self.gapp.kwargs['selection'])
-        # prepare a copy of the SVG for rendering context images
-        svg_hidden_selections = copy.deepcopy(INKSCAPE_SVG)
-        for rect in self.gapp.kwargs['selection']:
-            new_rect = svg_hidden_selections.getElementById(rect.get("id"))
-            new_rect.style['fill'] = 'none'
-            new_rect.style['stroke'] = 'none'
-        # render each icon and context image and store them
-        # in the selection_item ListStore
-        for rect in self.gapp.kwargs['selection']:
-            icon_image = rect_icon_image(rect, svg_render)
-            context_image = chip_context_image(rect, svg_hidden_selections)
-            selection_items.append(
-                # See selection_columns in ui file or Column(IntEnum)
-                [context_image, icon_image, icon_image.copy(),
-                 rect.get("id"), "", rect.get("id"), False])
-
         self.selections_icon_view = self.widget('selections_icon_view')
-        self.selections_icon_view.set_pixbuf_column(Column.DISPLAY_ICON)
-        self.selections_icon_view.set_text_column(Column.DISPLAY_NAME)
-        self.selections_icon_view.set_tooltip_column(Column.RECT_NAME)
-        self.selections_icon_view.set_item_width(64)
+
+        svg = self.gapp.kwargs['svg']
+        selection = self.gapp.kwargs['selection']
+
+        # nothing is matched yet, kept up to date by set_chip_select
+        self.unassigned = len(selection)
+
+        # bounding boxes are inkex python, get them up front
+        # in document coordinates (rects are often in transformed layers)
+        rect_bbs = [rect.bounding_box(rect.getparent().composed_transform())
+                    for rect in selection]
+
+        # render the svg once, icons and context images are both cut from it
+        svg_render = svg_without_selections_as_pixbuf(
+            svg, selection, svg_render_scale(svg, rect_bbs))
+        render_scale = render_scale_factors(svg_render, svg)
+        # context images are drawn with cairo, convert the render only once
+        svg_surface = Gdk.cairo_surface_create_from_pixbuf(svg_render, 1,
+                                                           None)
+        # workers only get plain values, never the inkex document
+        svg_size = (svg.viewbox_width, svg.viewbox_height)
+
+        def selection_images(rect_bb: inkex.BoundingBox
+                             ) -> Tuple[GdkPixbuf.Pixbuf, cairo.ImageSurface]:
+            '''Return the (icon, context) images for a selection
+            (runs on the thread pool, only GdkPixbuf and cairo calls)'''
+            return (rect_icon_image(rect_bb, svg_render, render_scale),
+                    chip_context_surface(rect_bb, svg_size, svg_surface,
+                                         render_scale))
+
+        def fill_selection_items() -> Iterator[bool]:
+            '''Add selections to selection_items a batch at a time
+            (an idle callback, yields False when done)'''
+            # plain ints, so they pass straight through to Gtk
+            columns = [int(column) for column in Column]
+            # render each icon and context image, the pixel work is in C
+            # (and doesn't hold the GIL) so spread it over a thread pool
+            with concurrent.futures.ThreadPoolExecutor() as executor:
+                rows = zip(selection, executor.map(selection_images,
+                                                   rect_bbs))
+                while batch := list(itertools.islice(rows, IDLE_FILL_BATCH)):
+                    first_batch = len(selection_items) == 0
+                    for rect, (icon_image, context_surface) in batch:
+                        rect_id = rect.get("id")
+                        # Gdk stays on the main thread
+                        context_image = Gdk.pixbuf_get_from_surface(
+                            context_surface, 0, 0,
+                            context_surface.get_width(),
+                            context_surface.get_height())
+                        selection_items.insert_with_valuesv(
+                            -1, columns,
+                            # See selection_columns in ui file or Column
+                            # the display icon starts out as the rect icon
+                            # itself, update_iconview_icon copies before
+                            # changing it
+                            [context_image, icon_image, icon_image,
+                             rect_id, "", rect_id, False])
+                    if first_batch:
+                        self.selections_icon_view.select_path(
+                            Gtk.TreePath.new_first())
+                    yield True
+            yield False
+
+        # pixbuf, text, and tooltip columns are set in the ui file
         self.selections_icon_view.connect(
             'selection-changed', self.update_selection, selection_items)
-        self.selections_icon_view.select_path(
-            selection_items.get_path(selection_items.get_iter_first()))
+        # selections are added once the window is showing
+        GLib.idle_add(
+            self.close_on_fill_error(fill_selection_items()).__next__)
 
     def setup_accelerators(self) -> None:
         '''Window keyboard shortcuts'''
@@ -344,22 +601,34 @@ class SelectionWindow(inkex.gui.Window):
         selection_items = self.selections_icon_view.get_model()
         path = self.selections_icon_view.get_selected_items()
         if box.get_selected_row() is None and path:
-            selection_items.set_value(selection_items.get_iter(path),
-                                      Column.CHIP_SELECT, "")
+            self.set_chip_select(selection_items, path, "")
         self.update_match(box)
 
+    def set_chip_select(self, selection_items: Gtk.ListStore,
+                        path: Gtk.TreePath, chip_name: str) -> None:
+        '''Set the chip matched to a selection,
+        and keep the unassigned count in step'''
+        previous = selection_items[path][Column.CHIP_SELECT]
+        if previous == "" and chip_name != "":
+            self.unassigned -= 1
+        elif previous != "" and chip_name == "":
+            self.unassigned += 1
+        selection_items.set_value(selection_items.get_iter(path),
+                                  Column.CHIP_SELECT, chip_name)
+
     def update_iconview_icon(self, selection_items: Gtk.ListStore,
                              path: Gtk.TreePath) -> None:
         '''Update the iconview icon for various states'''
         # NOTE: scaling causes the new pixbuf to be too small to
         # hold full size icons so we always recopy from the original
+        # (the normal icon is never drawn on, so it shares the original)
 
         if (selection_items[path][Column.CHIP_SELECT] == "" and not
                 selection_items[path][Column.ON_REVERSE]):
             # normal: unmatched, no reverse
             selection_items.set_value(
                 selection_items.get_iter(path), Column.DISPLAY_ICON,
-                selection_items[path][Column.RECT_ICON].copy())
+                selection_items[path][Column.RECT_ICON])
         if (selection_items[path][Column.CHIP_SELECT] == "" and
                 selection_items[path][Column.ON_REVERSE]):
             # shrunk: unmatched, reverse
@@ -407,8 +676,8 @@ class SelectionWindow(inkex.gui.Window):
             selected_chip_row = box.get_selected_row() if box else None
             if selected_chip_row:
                 selected_chip_index = selected_chip_row.get_index()
-                selection_items.set_value(
-                    selection_items.get_iter(path), Column.CHIP_SELECT,
+                self.set_chip_select(
+                    selection_items, path,
                     self.chip_items[selected_chip_index].name)
 
             self.update_iconview_icon(selection_items, path)
@@ -431,30 +700,22 @@ class SelectionWindow(inkex.gui.Window):
                 self.widget('selection_label').set_text(
                     selection_items[path][Column.RECT_NAME])
 
-        apply_button = self.widget('apply_button')
-        if self.populate_status_bar(selection_items) == 0:
-            apply_button.set_sensitive(True)
-        else:
-            apply_button.set_sensitive(False)
+        self.widget('apply_button').set_sensitive(
+            self.populate_status_bar() == 0)
 
-    def populate_status_bar(self, selection_items: Gtk.ListStore) -> int:
+    def populate_status_bar(self) -> int:
         '''Set the status bar message (remaining match count)'''
-        item_iter = selection_items.get_iter_first()
-        item_remaining_count: int = selection_items.iter_n_children()
-        while item_iter:
-            if selection_items.get_value(item_iter, Column.CHIP_SELECT) != "":
-                item_remaining_count -= 1
-            item_iter = selection_items.iter_next(item_iter)
-
         status_bar = self.widget('status_bar')
         context_id = status_bar.get_context_id("update_match")
-        if item_remaining_count == 0:
+        # replace the previous message instead of stacking another one
+        status_bar.remove_all(context_id)
+        if self.unassigned == 0:
             status_bar.push(context_id, "All images are assigned")
         else:
-            status_bar.push(context_id, str(item_remaining_count) +
-                            " images left to assign.")
+            status_bar.push(context_id,
+                            f"{self.unassigned} images left to assign.")
 
-        return item_remaining_count
+        return self.unassigned
 
     def update_selection(self, view: Gtk.IconView,
                          selection_items: Gtk.ListStore) -> None:
@@ -475,11 +736,8 @@ class SelectionWindow(inkex.gui.Window):
             self.widget('chip_reverse').set_active(
                 selection_items[path][Column.ON_REVERSE])
             match = selection_items[path][Column.CHIP_SELECT]
-            if match:
-                chip_index = 0
-                while self.chip_items.get_item(chip_index).name != match:
-                    chip_index += 1
-
+            chip_index = self.chip_index_by_name.get(match)
+            if chip_index is not None:
                 chip_box = self.widget('chip_list_box')
                 row = chip_box.get_row_at_index(chip_index)
                 chip_box.select_row(row)
@@ -505,6 +763,8 @@ class SelectionApp(inkex.gui.GtkApp):
     ui_dir = os.path.join(os.path.dirname(__file__))
     app_name = "org.epakai.extension.board_annotate"
     windows = [SelectionWindow]
+    # set when the window closed because its lists couldn't be filled
+    fill_failed = False
 
 
 class Position(Enum):
@@ -527,25 +787,88 @@ class Gutter:
         self.image_ratio = (YAML_CONFIG['image_ratio']
                             if 'image_ratio' in YAML_CONFIG
                             else 0.6)
+        # constant for the run, saves a lookup every placement
+        self.viewbox_width = INKSCAPE_SVG.viewbox_width
+        self.viewbox_height = INKSCAPE_SVG.viewbox_height
         match position:
             case Position.ABOVE:
                 self.gutter_size = board_image.top
                 self.main_image_edge = board_image.top
             case Position.BELOW:
                 self.gutter_size = (
-                    INKSCAPE_SVG.viewbox_height - board_image.bottom)
+                    self.viewbox_height - board_image.bottom)
                 self.main_image_edge = board_image.bottom
             case Position.LEFT:
                 self.gutter_size = board_image.left
                 self.main_image_edge = board_image.left
             case Position.RIGHT:
                 self.gutter_size = (
-                    INKSCAPE_SVG.viewbox_width - board_image.right)
+                    self.viewbox_width - board_image.right)
                 self.main_image_edge = board_image.right
 
-        stroke_width = INKSCAPE_SVG.viewport_to_unit("1mm")
         self.image_display_size = (self.gutter_size * self.image_ratio -
-                                   stroke_width)
+                                   STROKE_WIDTH)
+        # surrounds are centered on their stroke
+        self.half_stroke_width = 0.5 * STROKE_WIDTH
+
+        # annotations are placed along x in ABOVE and BELOW gutters,
+        # along y in LEFT and RIGHT gutters
+        self.horizontal = position in (Position.ABOVE, Position.BELOW)
+
+        # Placement across the gutter never changes, only the offset
+        # along it does, so work out the across parts once.
+        # surround_across and text_across are (position, size),
+        # image_across is position
+        edge_stroke_image_offset = (self.main_image_edge + STROKE_WIDTH +
+                                    self.image_display_size)
+        match position:
+            case Position.ABOVE:
+                self.surround_across = (self.half_stroke_width,
+                                        self.main_image_edge - STROKE_WIDTH)
+                self.image_across = (self.main_image_edge -
+                                     self.image_display_size - STROKE_WIDTH)
+                self.text_across = (
+                    STROKE_WIDTH,
+                    0.5 * (self.main_image_edge - self.image_display_size -
+                           (2 * STROKE_WIDTH)))
+            case Position.BELOW:
+                self.surround_across = (
+                    self.main_image_edge + self.half_stroke_width,
+                    self.viewbox_height - self.main_image_edge - STROKE_WIDTH)
+                self.image_across = self.main_image_edge + STROKE_WIDTH
+                self.text_across = (
+                    edge_stroke_image_offset,
+                    0.5 * (self.viewbox_height - STROKE_WIDTH -
+                           edge_stroke_image_offset))
+            case Position.LEFT:
+                self.surround_across = (self.half_stroke_width,
+                                        self.main_image_edge - STROKE_WIDTH)
+                self.image_across = (self.main_image_edge -
+                                     self.image_display_size - STROKE_WIDTH)
+                self.text_across = (
+                    STROKE_WIDTH,
+                    (self.main_image_edge - self.image_display_size -
+                     STROKE_WIDTH))
+            case Position.RIGHT:
+                self.surround_across = (
+                    self.main_image_edge + self.half_stroke_width,
+                    self.viewbox_width - self.main_image_edge - STROKE_WIDTH)
+                self.image_across = self.main_image_edge + STROKE_WIDTH
+                self.text_across = (
+                    edge_stroke_image_offset,
+                    (self.viewbox_width - STROKE_WIDTH -
+                     edge_stroke_image_offset))
+        # title and description split the gutter depth in horizontal
+        # gutters, and the annotation length in vertical ones
+        self.text_along_scale = 1.0 if self.horizontal else 0.5
+
+    def oriented(self, along: float, across: float, along_size: float,
+                 across_size: float) -> Tuple[float, float, float, float]:
+        """return tuple of x, y, width, height
+        from the position and size along and across the gutter"""
+        if self.horizontal:
+            return (along, across, along_size, across_size)
+        return (across, along, across_size, along_size)
 
     def get_approximate_corners(self) -> Tuple[List[float], List[float]]:
         """
@@ -554,15 +877,9 @@ class Gutter:
         Gutter's don't know their contents, so the second corner is made up
         (based on a square image)
         """
-        match self.position:
-            case Position.ABOVE | Position.BELOW:
-                return ([self.offset, self.main_image_edge],
-                        [self.offset + self.image_display_size,
-                         self.main_image_edge])
-            case Position.LEFT | Position.RIGHT:
-                return ([self.main_image_edge, self.offset],
-                        [self.main_image_edge,
-                         self.offset + self.image_display_size])
+        x, y, width, height = self.oriented(
+            self.offset, self.main_image_edge, self.image_display_size, 0)
+        return ([x, y], [x + width, y + height])
 
     def get_position_size(self, width: int, height: int
                           ) -> Tuple[float, float, float, float]:
@@ -573,150 +890,78 @@ class Gutter:
             width = self.image_display_size
             height = self.image_display_size
 
-        stroke_width = INKSCAPE_SVG.viewport_to_unit("1mm")
-        match self.position:
-            case Position.ABOVE:
-                return (
-                    self.offset + (0.5 * stroke_width),
-                    0 + (0.5 * stroke_width),
-                    (self.image_display_size * (width/height) + stroke_width),
-                    self.main_image_edge - stroke_width)
-            case Position.BELOW:
-                return (
-                    self.offset + (0.5 * stroke_width),
-                    self.main_image_edge + (0.5 * stroke_width),
-                    (self.image_display_size * (width/height) + stroke_width),
-                    (INKSCAPE_SVG.viewbox_height -
-                     self.main_image_edge - stroke_width))
-            case Position.LEFT:
-                return (
-                    0 + (0.5 * stroke_width),
-                    self.offset + (0.5 * stroke_width),
-                    self.main_image_edge - stroke_width,
-                    (self.image_display_size * (height/width) + stroke_width))
-            case  Position.RIGHT:
-                return (
-                    self.main_image_edge + (0.5 * stroke_width),
-                    self.offset + (0.5 * stroke_width),
-                    (INKSCAPE_SVG.viewbox_width -
-                     self.main_image_edge - stroke_width),
-                    (self.image_display_size * (height/width) + stroke_width))
+        ratio = width / height if self.horizontal else height / width
+        surround_position, surround_size = self.surround_across
+        return self.oriented(self.offset + self.half_stroke_width,
+                             surround_position,
+                             self.image_display_size * ratio + STROKE_WIDTH,
+                             surround_size)
 
     def get_image_position_size(self, width: int, height: int
                                 ) -> Tuple[float, float, float, float]:
         """return tuple of x, y, width, height
         where the image should be placed"""
-        stroke_width = INKSCAPE_SVG.viewport_to_unit("1mm")
-        match self.position:
-            case Position.ABOVE:
-                return (
-                    self.offset + stroke_width,
-                    (self.main_image_edge -
-                     self.image_display_size - stroke_width),
-                    self.image_display_size * (width / height),
-                    self.image_display_size)
-            case Position.BELOW:
-                return (
-                    self.offset + stroke_width,
-                    self.main_image_edge + stroke_width,
-                    self.image_display_size * (width / height),
-                    self.image_display_size)
-            case Position.LEFT:
-                return (
-                    (self.main_image_edge -
-                     self.image_display_size - stroke_width),
-                    self.offset + stroke_width,
-                    self.image_display_size,
-                    self.image_display_size * (height / width))
-            case Position.RIGHT:
-                return (
-                    self.main_image_edge + stroke_width,
-                    self.offset + stroke_width,
-                    self.image_display_size,
-                    self.image_display_size * (height / width))
-
-    def get_text_position_size(self, width: int, height: int, second: bool
-                               ) -> Tuple[float, float, float, float]:
-        """return tuple of x, y, width, height
-        where the title should be placed"""
+        ratio = width / height if self.horizontal else height / width
+        return self.oriented(self.offset + STROKE_WIDTH, self.image_across,
+                             self.image_display_size * ratio,
+                             self.image_display_size)
+
+    def get_text_position_size(
+            self, width: int, height: int
+    ) -> Tuple[Tuple[float, float, float, float],
+               Tuple[float, float, float, float]]:
+        """return tuple of (title, description) boxes, each x, y, width, height
+        where the text should be placed"""
         # Work around annotations without images
         if width == 0 or height == 0:
             width = self.image_display_size
             height = self.image_display_size
 
-        stroke_width = INKSCAPE_SVG.viewport_to_unit("1mm")
-        width_scaled_image_size = self.image_display_size * (width / height)
-        height_scaled_image_size = self.image_display_size * (height / width)
-        edge_stroke_image_offset = (self.main_image_edge + stroke_width +
-                                    self.image_display_size)
-        above_height = 0.5 * (self.main_image_edge - self.image_display_size -
-                              (2 * stroke_width))
-        below_height = 0.5 * ((INKSCAPE_SVG.viewbox_height - stroke_width -
-                               edge_stroke_image_offset))
-        vertical_height = 0.5 * height_scaled_image_size
-        match self.position:
-            case Position.ABOVE:
-                return (
-                    self.offset + stroke_width,
-                    stroke_width + (above_height if second else 0),
-                    width_scaled_image_size,
-                    above_height)
-            case Position.BELOW:
-                return (
-                    self.offset + stroke_width,
-                    edge_stroke_image_offset + (below_height if second else 0),
-                    width_scaled_image_size,
-                    below_height)
-            case Position.LEFT:
-                return (
-                    stroke_width,
-                    (self.offset + stroke_width +
-                     (vertical_height if second else 0)),
-                    (self.main_image_edge - self.image_display_size -
-                     stroke_width),
-                    vertical_height)
-            case Position.RIGHT:
-                return (
-                    edge_stroke_image_offset,
-                    (self.offset + stroke_width +
-                     (vertical_height if second else 0)),
-                    (INKSCAPE_SVG.viewbox_width - stroke_width -
-                     edge_stroke_image_offset),
-                    vertical_height)
+        ratio = width / height if self.horizontal else height / width
+        text_position, text_size = self.text_across
+        title = self.oriented(
+            self.offset + STROKE_WIDTH, text_position,
+            self.text_along_scale * self.image_display_size * ratio,
+            text_size)
+
+        # the description box sits directly below the title box
+        title_x, title_y, title_width, title_height = title
+        return (title,
+                (title_x, title_y + title_height, title_width, title_height))
 
     def increment(self, width: float, height: float) -> None:
         """set up for placing the next annotation"""
         self.index += 1
-        stroke_width = INKSCAPE_SVG.viewport_to_unit("1mm")
-        match self.position:
-            case Position.ABOVE | Position.BELOW:
-                self.offset += width + stroke_width
-            case Position.LEFT | Position.RIGHT:
-                self.offset += height + stroke_width
+        self.offset += (width if self.horizontal else height) + STROKE_WIDTH
 
 
 class Annotation(inkex.Layer):
     """Annotation as an inkscape layer"""
     def __init__(self, rectangle: inkex.Rectangle, name: str, description: str,
-                 image_path: str, gdkpixbuf: GdkPixbuf.Pixbuf,
-                 color: str, reverse: bool) -> None:
+                 image_path: str, image_size: Optional[Tuple[int, int]],
+                 color: inkex.Color, reverse: bool) -> None:
         self.rectangle = rectangle
         self.name = name
         self.description = description
-        self.color = inkex.Color(color)
+        self.color = color
         self.reverse = reverse
-        self.gdkpixbuf = gdkpixbuf
+        self.image_size = image_size
         self.image_path = image_path
 
-        if self.gdkpixbuf is not None:
-            self.image_width = gdkpixbuf.get_width()
-            self.image_height = gdkpixbuf.get_height()
+        if self.image_size is not None:
+            self.image_width, self.image_height = self.image_size
         else:
             self.image_width, self.image_height = 0.0, 0.0
 
+        # connectors need a url id like '#id'
+        self.rectangle_url = rectangle.get_id(as_url=1)
+
         self.gutter: Optional[Gutter] = None  # set in draw
         self.svg_image: inkex.Image = None  # set in draw_image
         self.surround: inkex.Rectangle = None  # set in draw_surround
+        self.surround_url = ''  # set in draw_surround
+        # set in draw_surround
+        self.surround_position_size = (0.0, 0.0, 0.0, 0.0)
 
         super().__init__()
 
@@ -741,24 +986,26 @@ class Annotation(inkex.Layer):
             raise AssertionError(
                 "Tried to draw without any gutter to draw it in")
 
-        INKSCAPE_SVG.add(self)  # Add the Annotation layer
-
+        # fill the layer before it's in the document,
+        # the document then only sees one addition per annotation
         self.draw_image()
         self.draw_surround()
         self.draw_text()
         self.draw_connector()
+        INKSCAPE_SVG.add(self)  # Add the Annotation layer
         self.update_rectangle_style()
 
         # Increment the gutter after everything is drawn
-        surround_bb = self.surround.bounding_box()
-        gutter.increment(surround_bb.width, surround_bb.height)
+        # (the surround size is known, no need for a bounding_box)
+        _, _, surround_width, surround_height = self.surround_position_size
+        gutter.increment(surround_width, surround_height)
 
     def draw_image(self) -> None:
         """embed and place the annotation image in the original svg"""
         if self.gutter is None:
             raise AssertionError(
                 "Tried to draw_image without any gutter to draw it in")
-        if self.image_path and self.gdkpixbuf:
+        if self.image_path and self.image_size:
             position_size = self.gutter.get_image_position_size(
                 self.image_width, self.image_height)
             # TODO inkscape 1.5 adds inkex.Image
@@ -774,18 +1021,20 @@ class Annotation(inkex.Layer):
         if self.gutter is None:
             raise AssertionError(
                 "Tried to draw_image without any gutter to draw it in")
-        position_size = self.gutter.get_position_size(
+        self.surround_position_size = self.gutter.get_position_size(
             self.image_width, self.image_height)
-        stroke_width = INKSCAPE_SVG.viewport_to_unit("1mm")
-        self.surround = inkex.Rectangle.new(*position_size)
-        self.surround.style['stroke-width'] = stroke_width
+        self.surround = inkex.Rectangle.new(*self.surround_position_size)
+        self.surround.style['stroke-width'] = STROKE_WIDTH
         self.surround.style.set_color(self.color, 'stroke')
         self.surround.style.set_color(inkex.Color('none'), 'fill')
         # Prevent connectors being drawn through adjacent annotations
         # TODO would like to avoid them passing through the gutter at all
         self.surround.set("inkscape:connector-avoid", 'true')
+        self.set_unique_id(self.surround)
         self.add(self.surround)
         self.surround.label = "surround"
+        # duplicates connect to this surround too, keep its url
+        self.surround_url = self.surround.get_id(as_url=1)
 
     def draw_text(self) -> None:
         """Place invisible boxes, and shape the text inside them.
@@ -797,35 +1046,36 @@ class Annotation(inkex.Layer):
             raise AssertionError(
                 "Tried to draw_text without any gutter to draw it in")
 
-        title_box_position_size = self.gutter.get_text_position_size(
-            self.image_width, self.image_height, second=False)
+        title_box_position_size, desc_box_position_size = (
+            self.gutter.get_text_position_size(self.image_width,
+                                               self.image_height))
         title_box = inkex.Rectangle.new(*title_box_position_size)
 
         title_box.style.set_color(inkex.Color('none'), 'stroke')
         title_box.style.set_color(inkex.Color('none'), 'fill')
+        self.set_unique_id(title_box)
         self.add(title_box)
         title_box.label = "title shape"
 
         title = inkex.TextElement()
         title.text = self.name
-        title.style['font-size'] = INKSCAPE_SVG.viewport_to_unit("10pt")
+        title.style['font-size'] = TITLE_FONT_SIZE
         title.style['text-anchor'] = "middle"
         title.style['shape-inside'] = title_box.get_id(as_url=2)
         self.add(title)
         title.label = "title text"
 
-        desc_box_position_size = self.gutter.get_text_position_size(
-            self.image_width, self.image_height, second=True)
         desc_box = inkex.Rectangle.new(*desc_box_position_size)
 
         desc_box.style.set_color(inkex.Color('none'), 'stroke')
         desc_box.style.set_color(inkex.Color('none'), 'fill')
+        self.set_unique_id(desc_box)
         self.add(desc_box)
         desc_box.label = "description shape"
 
         desc = inkex.TextElement()
         desc.text = self.description
-        desc.style['font-size'] = INKSCAPE_SVG.viewport_to_unit("8pt")
+        desc.style['font-size'] = DESC_FONT_SIZE
         desc.style['text-anchor'] = "start"
         desc.style['shape-inside'] = desc_box.get_id(as_url=2)
         self.add(desc)
@@ -834,7 +1084,7 @@ class Annotation(inkex.Layer):
     def draw_connector(self, duplicate: Optional[Self] = None) -> None:
         """connect the surrounding rect and the old rect with a path"""
         path = inkex.PathElement()
-        path.style['stroke-width'] = INKSCAPE_SVG.viewport_to_unit("1mm")
+        path.style['stroke-width'] = STROKE_WIDTH
         path.style.set_color(self.color, 'stroke')
         if self.reverse:
             path.style['stroke-dasharray'] = '2,1'
@@ -842,22 +1092,25 @@ class Annotation(inkex.Layer):
         # Make it a connector
         path.set("inkscape:connector-type", "polyline")
         path.set("inkscape:connector-curvature", 0)
-        # Connections need a url id like '#id'
-        path.set("inkscape:connection-start", self.rectangle.get_id(as_url=1))
+        path.set("inkscape:connection-start", self.rectangle_url)
         if duplicate is None:
-            path.set("inkscape:connection-end", self.surround.get_id(as_url=1))
+            path.set("inkscape:connection-end", self.surround_url)
             self.add(path)
         else:
-            path.set("inkscape:connection-end",
-                     duplicate.surround.get_id(as_url=1))
+            path.set("inkscape:connection-end", duplicate.surround_url)
             duplicate.add(path)
 
         path.label = "connector"
 
+    @staticmethod
+    def set_unique_id(element: inkex.BaseElement) -> None:
+        """Give an element a document unique id,
+        get_id can't make one until the element is in the document"""
+        element.set('id', INKSCAPE_SVG.get_unique_id(element.TAG))
+
     def update_rectangle_style(self) -> None:
         """Give the user drawn rectangle a matching color and stroke style"""
-        self.rectangle.style['stroke-width'] = (
-            INKSCAPE_SVG.viewport_to_unit("1mm"))
+        self.rectangle.style['stroke-width'] = STROKE_WIDTH
         self.rectangle.style.set_color(self.color, 'stroke')
         self.rectangle.style.set_color(inkex.Color("none"), 'fill')
         if self.reverse:
@@ -875,6 +1128,13 @@ def annotate_board(selection_items: Gtk.ListStore,
                    chip_items: Gtk.ListStore) -> None:
     """Set up the gutters and iterate through the selections
     drawing annotations"""
+    global STROKE_WIDTH
+    global TITLE_FONT_SIZE
+    global DESC_FONT_SIZE
+    STROKE_WIDTH = INKSCAPE_SVG.viewport_to_unit("1mm")
+    TITLE_FONT_SIZE = INKSCAPE_SVG.viewport_to_unit("10pt")
+    DESC_FONT_SIZE = INKSCAPE_SVG.viewport_to_unit("8pt")
+
     board_image = find_board_image()
     gutter_a, gutter_b = None, None
     if YAML_CONFIG['gutter'] == 'horizontal':
@@ -888,35 +1148,32 @@ def annotate_board(selection_items: Gtk.ListStore,
 
     colors = AnnotateColors()
 
-    completed: List[Annotation] = []
+    chips_by_name: Dict[str, ChipItem] = {}
+    for chip_index in range(chip_items.get_n_items()):
+        chip_item = chip_items.get_item(chip_index)
+        chips_by_name[chip_item.name] = chip_item
+    # selected rects by id, getElementById searches the whole document
+    rects_by_id = {rect.get('id'): rect for rect in INKSCAPE_SVG.selection}
+    completed: Dict[str, Annotation] = {}
     for selection in selection_items:
+        # read the columns needed from each row in one go
+        rect_name, chip_select, on_reverse = selection_items.get(
+            selection.iter,
+            Column.RECT_NAME, Column.CHIP_SELECT, Column.ON_REVERSE)
         # Create annotation
-        annotation: Optional[Annotation] = None
-        chip_index = 0
-        while chip_items.get_item(chip_index) is not None:
-            chip_item = chip_items.get_item(chip_index)
-            if (chip_item.name ==
-                    selection_items.get_value(selection.iter,
-                                              Column.CHIP_SELECT)):
-                annotation = Annotation(
-                    rectangle=INKSCAPE_SVG.getElementById(
-                        selection_items.get_value(selection.iter,
-                                                  Column.RECT_NAME)),
-                    name=chip_item.name,
-                    description=chip_item.description,
-                    image_path=chip_item.image_path,
-                    gdkpixbuf=chip_item.image,
-                    color=colors.next(),
-                    reverse=selection_items.get_value(selection.iter,
-                                                      Column.ON_REVERSE))
-
-            chip_index += 1
-
-        if annotation is None:
+        chip_item = chips_by_name.get(chip_select)
+        if chip_item is None:
             raise AssertionError(
-                "Failed to create Annotation for "
-                f"""{selection_items.get_value(selection.iter,
-                                               Column.RECT_NAME)}""")
+                f"Failed to create Annotation for {rect_name}")
+        annotation = Annotation(
+            rectangle=rects_by_id[rect_name],
+            name=chip_item.name,
+            description=chip_item.description,
+            image_path=chip_item.image_path,
+            image_size=chip_item.image_size,
+            color=colors.next(),
+            reverse=on_reverse)
+
         # TODO still not happy with this method
         # Some ideas
         # - config option to select a distribution method
@@ -930,12 +1187,11 @@ def annotate_board(selection_items: Gtk.ListStore,
         # Probably easiest to store up the annotations, then pick a method
         # collection.deque can do operations from either side
 
-        duplicate = [anno for anno in completed
-                     if anno.name == annotation.name]
-        if duplicate:
+        duplicate = completed.get(annotation.name)
+        if duplicate is not None:
             # Already drew an annotation for this chip
             # connect to it instead of drawing again
-            annotation.draw_existing(duplicate[0])
+            annotation.draw_existing(duplicate)
         # Annotations go into the next position on gutter A or B
         # based on which is more empty, and which is closer
         else:
@@ -946,8 +1202,7 @@ def annotate_board(selection_items: Gtk.ListStore,
             else:
                 closest = closest_gutter(annotation, gutter_a, gutter_b)
                 annotation.draw(closest)
-
-        completed.append(annotation)
+            completed[annotation.name] = annotation
 
 
 def find_board_image() -> inkex.Image:
@@ -958,13 +1213,10 @@ def find_board_image() -> inkex.Image:
         return board_image
 
     # Find the biggest image
-    size = 0.0
-    for image in INKSCAPE_SVG.xpath("//svg:image"):
-        image_size = (float(image.get('width')) *
-                      float(image.get('height')))
-        if image_size > size:
-            size = image_size
-            board_image = image
+    board_image = max(INKSCAPE_SVG.iter(inkex.addNS('image', 'svg')),
+                      key=lambda image: (float(image.get('width', 0)) *
+                                         float(image.get('height', 0))),
+                      default=None)
 
     if board_image is not None:
         return board_image
@@ -1000,54 +1252,40 @@ class AnnotateColors:
     medium = ['mediumaquamarine', 'mediumblue', 'mediumorchid', 'mediumpurple',
               'mediumseagreen', 'mediumslateblue', 'mediumspringgreen',
               'mediumturquoise', 'mediumvioletred']
+    # built-in palettes by name, 'all' is concatenated once here
+    palettes = {'default': default, 'dark': dark, 'light': light,
+                'medium': medium, 'all': default + dark + light + medium}
 
     def __init__(self) -> None:
         """Read the palette configuration
-        and set up generator for returning colors"""
-        AnnotateColors.validate_colors(YAML_CONFIG)
-
+        and set up generator for returning colors
+        (the config was checked with validate_colors in effect)"""
         if 'palette' in YAML_CONFIG:
             palette = YAML_CONFIG['palette']
         else:
             palette = 'default'
 
+        colors: List[str]
         match palette:
-            case 'default':
-                self.iterator = self.color_gen(self.default)
-            case 'light':
-                self.iterator = self.color_gen(self.light)
-            case 'dark':
-                self.iterator = self.color_gen(self.dark)
-            case 'medium':
-                self.iterator = self.color_gen(self.medium)
-            case 'all':
-                self.iterator = self.color_gen(self.default + self.dark +
-                                               self.light + self.medium)
             # NOTE: random still repeats after all the colors have been used
             case 'all_random':
-                full_list = self.default + self.dark + self.light + self.medium
-                random.shuffle(full_list)
-                self.iterator = self.color_gen(full_list)
+                colors = list(self.palettes['all'])
+                random.shuffle(colors)
             case 'custom' | 'custom_random':
-                colors = YAML_CONFIG['colors']
-                for color in colors:
-                    inkex.Color(color)
-
+                colors = list(YAML_CONFIG['colors'])
                 if palette == 'custom_random':
                     random.shuffle(colors)
+            case _:
+                colors = self.palettes[palette]
 
-                self.iterator = self.color_gen(colors)
+        # the cycle hands out the parsed colors
+        self.iterator = itertools.cycle(
+            [parse_color(color) for color in colors])
 
-    def next(self) -> str:
+    def next(self) -> inkex.Color:
         """Get the next color to be used"""
         return next(self.iterator)
 
-    def color_gen(self,
-                  colors: List[str]) -> Generator[str, None, None]:
-        """Generator that returns infinite colors (sequence repeats)"""
-        while True:
-            yield from colors
-
     @staticmethod
     def validate_colors(config: Dict[str, Any]) -> None:
         """Check for valid color config"""
@@ -1065,7 +1303,7 @@ class AnnotateColors:
                     colors = config['colors']
                     for color in colors:
                         try:
-                            inkex.Color(color)
+                            parse_color(color)
                         except inkex.colors.ColorError as exc:
                             inkex.utils.errormsg(
                                 f"Invalid color in 'custom' palette: {color}")
@@ -1080,133 +1318,265 @@ class AnnotateColors:
                 raise inkex.utils.AbortExtension
 
 
+def parse_color(color: Any) -> inkex.Color:
+    """Return color parsed as an inkex.Color
+    the result may be shared between callers, don't modify it"""
+    # names, codes, and integers are cached, lists of channels can't be
+    if isinstance(color, (str, int)):
+        return parse_color_cached(color)
+    return inkex.Color(color)
+
+
+@functools.lru_cache(maxsize=256)
+def parse_color_cached(color: str | int) -> inkex.Color:
+    """Return color parsed as an inkex.Color, memoised"""
+    return inkex.Color(color)
+
+
 def closest_gutter(annotation: Annotation, gutter_a: Gutter,
                    gutter_b: Gutter) -> Gutter:
     """Return the closest gutter to the annotation user-drawn rectangle
     according to the next empty space"""
     rect = annotation.rectangle
     rect_transform = inkex.Transform(rect.get('transform'))
-    rect_corners = list(
-        rect_transform.apply_to_point(x) for x in
-        [(rect.left, rect.top), (rect.right, rect.top),
-         (rect.left, rect.bottom), (rect.right, rect.bottom)])
+    # each edge is parsed from the rect's attributes, read them once
+    left, top, right, bottom = rect.left, rect.top, rect.right, rect.bottom
+    rect_corners = [rect_transform.apply_to_point((left, top)),
+                    rect_transform.apply_to_point((right, top)),
+                    rect_transform.apply_to_point((left, bottom)),
+                    rect_transform.apply_to_point((right, bottom))]
+
+    def min_distance(target: List[float]) -> float:
+        '''Return the distance from the closest rect corner to target'''
+        # compare squared distances, only the closest needs a sqrt
+        target_x, target_y = target
+        return math.sqrt(min((x - target_x) ** 2 + (y - target_y) ** 2
+                             for x, y in rect_corners))
 
     gutter_a_corners = gutter_a.get_approximate_corners()
     gutter_b_corners = gutter_b.get_approximate_corners()
 
-    rect_to_a0 = sorted([math.dist(rect_corners[x], gutter_a_corners[0])
-                         for x in [0, 1, 2, 3]])
-    rect_to_a1 = sorted([math.dist(rect_corners[x], gutter_a_corners[1])
-                         for x in [0, 1, 2, 3]])
+    rect_to_a0 = min_distance(gutter_a_corners[0])
+    rect_to_a1 = min_distance(gutter_a_corners[1])
 
-    rect_to_b0 = sorted([math.dist(rect_corners[x], gutter_b_corners[0])
-                         for x in [0, 1, 2, 3]])
-    rect_to_b1 = sorted([math.dist(rect_corners[x], gutter_b_corners[1])
-                         for x in [0, 1, 2, 3]])
+    rect_to_b0 = min_distance(gutter_b_corners[0])
+    rect_to_b1 = min_distance(gutter_b_corners[1])
 
-    if (rect_to_a0[0] + rect_to_a1[0]) <= (rect_to_b0[0] + rect_to_b1[0]):
+    if (rect_to_a0 + rect_to_a1) <= (rect_to_b0 + rect_to_b1):
         return gutter_a
 
     return gutter_b
 
 
-def chip_context_image(rect: inkex.Rectangle,
-                       svg: inkex.SvgDocumentElement) -> GdkPixbuf.Pixbuf:
-    """Create an image of the context around a user-drawn rectangle"""
+def render_scale_factors(base_image: GdkPixbuf.Pixbuf,
+                         svg: inkex.SvgDocumentElement
+                         ) -> Tuple[float, float]:
+    """Return the (x, y) scales from svg user units to base_image pixels"""
+    return (base_image.get_width()/svg.viewbox_width,
+            base_image.get_height()/svg.viewbox_height)
+
+
+def chip_context_surface(rect_bb: inkex.BoundingBox,
+                         svg_size: Tuple[float, float],
+                         base_surface: cairo.ImageSurface,
+                         render_scale: Tuple[float, float]
+                         ) -> cairo.ImageSurface:
+    """Create an image of the context around a user-drawn rectangle
+    base_surface is a render of the whole svg with the selections removed,
+    svg_size is the svg's viewbox (width, height)
+    only uses cairo, so it is safe to run off the main thread"""
+    svg_width, svg_height = svg_size
+
+    size = 0.4 * min(svg_height, svg_width)
+    new_x = min(svg_width, max(0, rect_bb.center_x - (0.5 * size)))
+    new_y = min(svg_height, max(0, rect_bb.center_y - (0.5 * size)))
+
+    # scale the context area of the render to the preferred output size
+    output_size = 360
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
+                                 output_size, output_size)
+    context = cairo.Context(surface)
+    context.scale(output_size / size, output_size / size)
+    context.translate(-new_x, -new_y)
+    # context is now in svg user units, the render is in pixels
+    context.save()
+    context.scale(1 / render_scale[0], 1 / render_scale[1])
+    context.set_source_surface(base_surface, 0, 0)
+    context.paint()
+    context.restore()
+
     # make our chip rect visible
-    new_rect = svg.getElementById(rect.get("id"))
-    new_rect.style['stroke'] = 'red'
-
-    context_center_x = new_rect.bounding_box().center_x
-    context_center_y = new_rect.bounding_box().center_y
-    size = 0.4 * min(svg.viewbox_height, svg.viewbox_width)
-    new_x = min(svg.viewbox_width, max(0, context_center_x - (0.5 * size)))
-    new_y = min(svg.viewbox_height, max(0, context_center_y - (0.5 * size)))
-
-    # save svg state (using get so we can restore from actual string values)
-    original_viewbox = svg.get("viewBox")
-    original_width = svg.get("width")
-    original_height = svg.get("height")
-
-    # modify viewbox to fit our context
-    svg.set("viewBox", f"{new_x:f} {new_y:f} {size:f} {size:f}")
-    # set viewport to preferred output size
-    svg.set("width", 360)
-    svg.set("height", 360)
-    stream = Gio.MemoryInputStream.new_from_bytes(
-        GLib.Bytes.new(svg.tostring()))
-    render = GdkPixbuf.Pixbuf.new_from_stream(stream, None)
-
-    # restore svg state
-    new_rect.style['stroke'] = 'none'
-
-    if original_viewbox is None:
-        svg.pop("viewBox")
-    else:
-        svg.set("viewBox", original_viewbox)
-    if original_width is None:
-        svg.pop("width")
-    else:
-        svg.set("width", original_width)
-    if original_height is None:
-        svg.pop("height")
-    else:
-        svg.set("height", original_height)
+    context.rectangle(rect_bb.left, rect_bb.top, rect_bb.width, rect_bb.height)
+    context.set_source_rgb(1, 0, 0)
+    context.set_line_width(2 * size / output_size)
+    context.stroke()
 
     # NOTE: images may include the inkscape page area which may be transparent
     #       Gtk will render it transparent.
     #       It looks odd, but provides context that we're beyond the image edge
-    return render
-
+    return surface
+
+
+@functools.lru_cache(maxsize=256)
+def chip_image_size(image_path: str) -> Tuple[int, int]:
+    """Return the (width, height) of an image file
+    only the header is read, pixel data is never decoded"""
+    # png and jpeg are read directly, without loading a pixbuf loader
+    with open(image_path, 'rb') as handle:
+        size = header_image_size(handle)
+    if size is not None:
+        return size
+
+    image_format, width, height = GdkPixbuf.Pixbuf.get_file_info(image_path)
+    if image_format is None:
+        raise ValueError(f"{image_path} is not a recognized image format")
+    return (width, height)
+
+
+def header_image_size(handle: io.BufferedReader) -> Optional[Tuple[int, int]]:
+    """Return the (width, height) from a png or jpeg header,
+    or None for other or unreadable images"""
+    header = handle.read(24)
+    if header.startswith(b"\x89PNG\r\n\x1a\n") and header[12:16] == b"IHDR":
+        width, height = struct.unpack(">II", header[16:24])
+        return (width, height)
+    if not header.startswith(b"\xff\xd8"):
+        return None
 
-def rect_icon_image(rect: inkex.Rectangle,
-                    base_image: GdkPixbuf.Pixbuf) -> GdkPixbuf.Pixbuf:
+    # jpeg, walk the marker segments to the first start of frame
+    handle.seek(2)
+    while True:
+        marker = handle.read(2)
+        if len(marker) < 2 or marker[0] != 0xff:
+            return None
+        marker_type = marker[1]
+        # fill bytes and markers without a segment
+        if marker_type == 0xff:
+            handle.seek(-1, os.SEEK_CUR)
+            continue
+        if marker_type == 0x01 or 0xd0 <= marker_type <= 0xd9:
+            continue
+        segment = handle.read(7)
+        if len(segment) < 7:
+            return None
+        length = struct.unpack(">H", segment[:2])[0]
+        # SOF0 to SOF15, except DHT, JPG, and DAC
+        if (0xc0 <= marker_type <= 0xcf
+                and marker_type not in (0xc4, 0xc8, 0xcc)):
+            height, width = struct.unpack(">HH", segment[3:7])
+            return (width, height)
+        handle.seek(length - 7, os.SEEK_CUR)
+
+
+def rect_icon_image(rect_bb: inkex.BoundingBox,
+                    base_image: GdkPixbuf.Pixbuf,
+                    render_scale: Tuple[float, float]) -> GdkPixbuf.Pixbuf:
     """Return an icon image of the rectangle"""
-    render_width = base_image.get_width()
-    render_height = base_image.get_height()
-    svg_width = INKSCAPE_SVG.viewbox_width
-    svg_height = INKSCAPE_SVG.viewbox_height
-
-    scale_factor = (render_width/svg_width + render_height/svg_height)/2
-
-    rect_bb = rect.bounding_box()
-    new_width = 2 * round(rect_bb.width * scale_factor * 1.4 / 2)
-    new_height = 2 * round(rect_bb.height * scale_factor * 1.4 / 2)
+    scale_x, scale_y = render_scale
+    new_width = 2 * round(rect_bb.width * scale_x * 1.4 / 2)
+    new_height = 2 * round(rect_bb.height * scale_y * 1.4 / 2)
     # make it square
     if new_width > new_height:
         new_height = new_width
     else:
         new_width = new_height
-    new_x = rect_bb.center_x * scale_factor - (new_width / 2)
-    new_y = rect_bb.center_y * scale_factor - (new_height / 2)
+    new_x = round(rect_bb.center_x * scale_x - (new_width / 2))
+    new_y = round(rect_bb.center_y * scale_y - (new_height / 2))
 
     crop_image = base_image.new_subpixbuf(new_x, new_y, new_width, new_height)
-    return crop_image.scale_simple(64, 64, GdkPixbuf.InterpType.BILINEAR)
+    return crop_image.scale_simple(
+        SELECTION_ICON_SIZE, SELECTION_ICON_SIZE,
+        scale_interp_type(new_width, SELECTION_ICON_SIZE))
+
+
+def scale_interp_type(source_size: int,
+                      target_size: int) -> GdkPixbuf.InterpType:
+    """Return the interpolation for scaling source_size to target_size
+    NEAREST near 1:1, BILINEAR for enlarging or a small shrink,
+    TILES (box averaging) for a big shrink"""
+    ratio = target_size / source_size
+    if 0.9 < ratio < 1.1:
+        return GdkPixbuf.InterpType.NEAREST
+    if ratio > 0.5:
+        return GdkPixbuf.InterpType.BILINEAR
+    return GdkPixbuf.InterpType.TILES
+
+
+def svg_render_scale(svg: inkex.SvgDocumentElement,
+                     rect_bbs: List[inkex.BoundingBox]) -> float:
+    """Return the scale, in pixels per svg user unit, to render the svg at
+    so context images and the icons of the selections in rect_bbs
+    are cut without upscaling (within RENDER_MAX_SIDE)
+    only as large as the crops need, the natural size of a large board
+    can be many megapixels"""
+    # context images are cut from 0.4 of the short side, rendering
+    # above the natural size keeps them sharp on small pages
+    scale = RENDER_SHORT_SIDE / min(svg.viewbox_width, svg.viewbox_height)
+    # icons are cut from a square 1.4 times the longer side of the
+    # selection, the smallest selection needs the largest scale
+    smallest_side = min((max(rect_bb.width, rect_bb.height)
+                         for rect_bb in rect_bbs), default=0)
+    if smallest_side > 0:
+        scale = max(scale, SELECTION_ICON_SIZE / (1.4 * smallest_side))
+    return min(scale, RENDER_MAX_SIDE / max(svg.viewbox_width,
+                                            svg.viewbox_height))
 
 
 def svg_without_selections_as_pixbuf(
-    svg: inkex.SvgDocumentElement, selections: Gtk.ListStore,
-        keep_rect: inkex.Rectangle = None) -> GdkPixbuf.Pixbuf:
-    """Return a pixbuf render of the svg
-    with keep_rect visible as a red unfilled rectangle,
-    and all other selections removed"""
-    # copy SVG, remove selections, except keep_rect
-    # TODO depending on the embedded images size this can be expensive
-    temp_svg = copy.deepcopy(svg)
-    for rect in selections:
-        if rect is keep_rect:
-            # NOTE: rect is still the inkscape copy, don't modify it
-            new_rect = temp_svg.getElementById(rect.get("id"))
-            new_rect.style['fill'] = 'none'
-            new_rect.style['stroke'] = 'red'
-        else:
-            new_rect = temp_svg.getElementById(rect.get("id"))
-            new_rect.getparent().remove(new_rect)
+        svg: inkex.SvgDocumentElement, selections: Gtk.ListStore,
+        scale: float) -> GdkPixbuf.Pixbuf:
+    """Return a pixbuf render of the svg at scale (see svg_render_scale)
+    with all selections removed"""
+    # modify the svg in place, everything is restored after rendering
+    # (a deepcopy of the whole document is expensive with embedded images)
+    removed: List[Tuple[inkex.BaseElement, int, inkex.Rectangle]] = []
+    try:
+        for rect in selections:
+            parent = rect.getparent()
+            removed.append((parent, parent.index(rect), rect))
+            parent.remove(rect)
+        svg_bytes = svg.tostring()
+    finally:
+        # reinsert in reverse order so the saved indexes stay valid
+        for parent, index, rect in reversed(removed):
+            parent.insert(index, rect)
+
+    # renders are reused (keyed on the svg content and the scale)
+    render_hash = hashlib.sha256(svg_bytes)
+    render_hash.update(struct.pack('<d', scale))
+    render_key = render_hash.digest()
+    cached = RENDER_CACHE.get(render_key)
+    if cached is not None:
+        RENDER_CACHE.move_to_end(render_key)
+        return cached
+
+    stream = Gio.MemoryInputStream.new_from_bytes(GLib.Bytes.new(svg_bytes))
+    render = GdkPixbuf.Pixbuf.new_from_stream_at_scale(
+        stream, round(svg.viewbox_width * scale),
+        round(svg.viewbox_height * scale), True, None)
+    RENDER_CACHE[render_key] = render
+    if len(RENDER_CACHE) > RENDER_CACHE_SIZE:
+        RENDER_CACHE.popitem(last=False)
+    return render
 
-    # Render it as a pixbuf
-    stream = Gio.MemoryInputStream.new_from_bytes(
-        GLib.Bytes.new(temp_svg.tostring()))
-    return GdkPixbuf.Pixbuf.new_from_stream(stream, None)
+
+# Mime types by the first 2 bytes of an image
+# each maps to the full magic header(s) and the mime type
+IMAGE_MAGIC_TYPES = {
+    b"\x89P": (b"\x89PNG", "image/png"),
+    b"\xff\xd8": (b"\xff\xd8", "image/jpeg"),
+    b"BM": (b"BM", "image/bmp"),
+    b"GI": ((b"GIF87a", b"GIF89a"), "image/gif"),
+    b"MM": (b"MM\x00\x2a", "image/tiff"),
+    b"II": (b"II\x2a\x00", "image/tiff"),
+}
+
+# Mime types for images without magic headers, by file extension
+IMAGE_EXTENSION_TYPES = {
+    # official IANA registered MIME is 'image/vnd.microsoft.icon' tho
+    ".ico": "image/x-icon",
+    ".svg": "image/svg+xml",
+}
 
 
 class BoardAnnotateImage(inkex.Rectangle):
@@ -1217,52 +1587,47 @@ class BoardAnnotateImage(inkex.Rectangle):
         """base64 encode the image and place it in an svg element"""
         # Borrowed from Inkscape 1.5 inkex.elements._image
         # Copyright (c) 2020 Martin Owens
-        with open(file_path, "rb") as handle:
-            file_type = BoardAnnotateImage.get_image_type(
-                file_path, handle.read(10))
-            handle.seek(0)
+        stat = os.stat(file_path)
+        cache_key = (file_path, stat.st_mtime, stat.st_size)
+        data_uri = EMBED_CACHE.get(cache_key)
+        if data_uri is None:
+            # one read, the header is sniffed from the same bytes
+            with open(file_path, "rb") as handle:
+                data = handle.read()
+            file_type = BoardAnnotateImage.get_image_type(file_path,
+                                                          data[:10])
             if file_type:
-                self.set(
-                    "xlink:href",
-                    f"data:{file_type};"
-                    "base64,"
-                    f"{base64.encodebytes(handle.read()).decode('ascii')}")
+                # b64encode doesn't wrap lines, data URIs don't need it
+                data_uri = (f"data:{file_type};"
+                            "base64,"
+                            f"{base64.b64encode(data).decode('ascii')}")
             else:
                 raise ValueError(
                     f"{file_path} is not of type image/png, image/jpeg, "
                     "image/bmp, image/gif, image/tiff, or image/x-icon")
+            EMBED_CACHE[cache_key] = data_uri
+            if len(EMBED_CACHE) > EMBED_CACHE_SIZE:
+                EMBED_CACHE.popitem(last=False)
+        EMBED_CACHE.move_to_end(cache_key)
+        self.set("xlink:href", data_uri)
 
     @staticmethod
     def get_image_type(path: str, header: bytes) -> Optional[str]:
         """Basic magic header checker, returns mime type"""
         # Borrowed from inkscape extension image_embed.py
         # Copyright (c) 2005,2007 Aaron Spike
-        for head, mime in (
-            (b"\x89PNG", "image/png"),
-            (b"\xff\xd8", "image/jpeg"),
-            (b"BM", "image/bmp"),
-            (b"GIF87a", "image/gif"),
-            (b"GIF89a", "image/gif"),
-            (b"MM\x00\x2a", "image/tiff"),
-            (b"II\x2a\x00", "image/tiff"),
-        ):
-            if header.startswith(head):
-                return mime
+        magic = IMAGE_MAGIC_TYPES.get(header[:2])
+        if magic is not None and header.startswith(magic[0]):
+            return magic[1]
 
         # ico files lack any magic... therefore we check the filename instead
-        for ext, mime in (
-            # official IANA registered MIME is 'image/vnd.microsoft.icon' tho
-            (".ico", "image/x-icon"),
-            (".svg", "image/svg+xml"),
-        ):
-            if path.endswith(ext):
-                return mime
-        return None
+        return IMAGE_EXTENSION_TYPES.get(os.path.splitext(path)[1].lower())
 
 
 def _debug_print(*args: List[str]) -> None:
     'Implement print in terms of inkex.utils.debug.'
-    inkex.utils.debug(' '.join([str(a) for a in args]))
+    if DEBUG:
+        inkex.utils.debug(' '.join(map(str, args)))
 
 
 if __name__ == '__main__':